@@ -1,9 +1,54 @@
 """
 Vercel API Client for Wan Worker
 """
+import json
+import socket
 import requests
+import threading
 import time
-from typing import Optional, Dict, Any
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Optional, Dict, Any, List, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Startup pre-connect gives up after this many seconds
+WARM_UP_TIMEOUT = 5
+
+
+def _encode_json(payload: Any) -> bytes:
+    """Serialize a request body (orjson if installed)"""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload).encode('utf-8')
+
+
+def _decode_json(response: requests.Response) -> Any:
+    """Parse a response body (orjson if installed)"""
+    if orjson is None:
+        return response.json()
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError as e:
+        # Keep the requests exception type callers already handle
+        raise requests.exceptions.JSONDecodeError(e.msg, e.doc, e.pos)
+
+
+class TCPKeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter whose sockets disable Nagle's algorithm and enable TCP keep-alive"""
+
+    socket_options = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault('socket_options', self.socket_options)
+        super().init_poolmanager(*args, **kwargs)
 
 
 class VercelAPIClient:
@@ -23,11 +68,136 @@ class VercelAPIClient:
         self.worker_token = worker_token
         self.worker_id = worker_id
         self.timeout = timeout
-        self.session = requests.Session()
-        self.session.headers.update({
+
+        # Reuse pooled keep-alive connections and retry transient failures.
+        # One host, so one pool; a few connections cover the main loop,
+        # heartbeats and background I/O without opening extra sockets.
+        retry = Retry(
+            total=5,
+            backoff_factor=0.3,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['POST', 'GET'])
+        )
+        self._adapter = TCPKeepAliveAdapter(
+            pool_connections=1,
+            pool_maxsize=4,
+            pool_block=True,
+            max_retries=retry
+        )
+
+        # Polling leases a task on the server, so a retried read timeout or
+        # 5xx could lease a second one and orphan the first. Only retry
+        # failures to connect, where the request never reached the server.
+        self._lease_adapter = TCPKeepAliveAdapter(
+            pool_connections=1,
+            pool_maxsize=2,
+            pool_block=True,
+            max_retries=Retry(total=3, connect=3, read=0, status=0, other=0,
+                              backoff_factor=0.3, allowed_methods=frozenset(['POST']))
+        )
+        self._next_task_url = f"{self.base_url}/worker/next-task"
+        self._headers = {
             'Authorization': f'Worker {worker_token}',
-            'Content-Type': 'application/json'
-        })
+            'Content-Type': 'application/json',
+            'Connection': 'keep-alive'
+        }
+        self._local = threading.local()
+
+        # Cleared once the server rejects the batched heartbeat payload
+        self._batch_heartbeat_supported = True
+
+        # Server-issued lease tokens for lightweight heartbeats, keyed by item_id
+        self._lease_tokens: Dict[str, str] = {}
+
+        # Presigned URL responses with their absolute expiry time
+        # (guarded by a lock: download and upload presigns run on different threads)
+        self._url_cache: Dict[str, Tuple[Dict[str, Any], float]] = {}
+        self._url_cache_lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        Session for the calling thread
+
+        requests.Session is not thread-safe, so heartbeat and prefetch threads
+        each get their own session. All sessions share the same adapters, so
+        every thread draws on the same keep-alive connection pools.
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', self._adapter)
+            session.mount('http://', self._adapter)
+            session.mount(self._next_task_url, self._lease_adapter)
+            session.headers.update(self._headers)
+            self._local.session = session
+        return session
+
+    def warm_up(self) -> bool:
+        """
+        Open a pooled connection to the API host ahead of the first poll
+
+        Resolves DNS and completes the TLS handshake so the first poll doesn't
+        pay for them. The connection lands in the next-task pool, since a poll
+        is the first real request. Sent once without retries and with a short
+        timeout so an unreachable API doesn't hold up startup; the response
+        status is irrelevant and failures are ignored.
+
+        Returns:
+            True if the host was reachable
+        """
+        try:
+            # Look the pool up with the same (environment-merged) settings a
+            # session request would use, otherwise the poll gets its own pool
+            adapter = self._lease_adapter
+            session = self.session
+            request = session.prepare_request(requests.Request('HEAD', self._next_task_url))
+            settings = session.merge_environment_settings(request.url, {}, None, None, None)
+            if hasattr(adapter, 'get_connection_with_tls_context'):
+                pool = adapter.get_connection_with_tls_context(
+                    request, settings['verify'], settings['proxies'], settings['cert']
+                )
+            else:  # requests < 2.32.2
+                pool = adapter.get_connection(request.url, settings['proxies'])
+            base_request = requests.Request('HEAD', self.base_url).prepare()
+            pool.urlopen('HEAD', adapter.request_url(base_request, settings['proxies']),
+                         retries=False, redirect=False,
+                         timeout=min(self.timeout, WARM_UP_TIMEOUT))
+            return True
+        except (urllib3.exceptions.HTTPError, requests.exceptions.RequestException):
+            return False
+
+    def _get_cached_url(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return a cached presign response unless it expires within 30 seconds"""
+        with self._url_cache_lock:
+            entry = self._url_cache.get(key)
+        if entry and entry[1] - time.time() > 30:
+            return entry[0]
+        return None
+
+    def _cache_url(self, key: str, data: Dict[str, Any]):
+        """Cache a presign response until its fixed expiry (never extended on hit)"""
+        now = time.time()
+
+        expires_in = data.get('expires_in')
+
+        with self._url_cache_lock:
+            # Drop expired entries so a long-running worker doesn't accumulate them
+            for stale_key in [k for k, (_, expires_at) in self._url_cache.items() if expires_at <= now]:
+                del self._url_cache[stale_key]
+
+            if expires_in:
+                self._url_cache[key] = (data, now + float(expires_in))
+
+    def invalidate_presigned_download_url(self, storage_path: str):
+        """Drop a cached download URL, e.g. after storage rejected it"""
+        with self._url_cache_lock:
+            self._url_cache.pop(f"download:{storage_path}", None)
+
+    def invalidate_presigned_upload_url(self, video_item_id: str, file_extension: str = "mp4"):
+        """Drop a cached upload URL, e.g. after storage rejected it"""
+        with self._url_cache_lock:
+            self._url_cache.pop(f"upload:{video_item_id}.{file_extension}", None)
 
     def get_next_task(self, lease_duration_seconds: int = 600) -> Optional[Dict[str, Any]]:
         """
@@ -40,17 +210,17 @@ class VercelAPIClient:
             Task dict with keys: item_id, group_id, photo_id, prompt, photo_storage_path, leased_until
             None if no task available
         """
-        url = f"{self.base_url}/worker/next-task"
+        url = self._next_task_url
         payload = {
             "worker_id": self.worker_id,
             "lease_duration_seconds": lease_duration_seconds
         }
 
         try:
-            response = self.session.post(url, json=payload, timeout=self.timeout)
+            response = self.session.post(url, data=_encode_json(payload), timeout=self.timeout)
             response.raise_for_status()
 
-            result = response.json()
+            result = _decode_json(response)
 
             # No task available
             if not result.get('success') or result.get('data') is None:
@@ -61,16 +231,60 @@ class VercelAPIClient:
         except requests.exceptions.RequestException as e:
             raise Exception(f"Failed to get next task: {str(e)}")
 
+    def get_next_tasks(self, batch_size: int,
+                       lease_duration_seconds: int = 600) -> List[Dict[str, Any]]:
+        """
+        Request up to batch_size tasks from the queue in one call
+
+        Servers that ignore batch_size and return a single task are handled too.
+
+        Args:
+            batch_size: Maximum number of tasks to lease
+            lease_duration_seconds: How long to lease each task (default: 600 seconds)
+
+        Returns:
+            List of task dicts (same keys as get_next_task), empty if no task available
+        """
+        url = self._next_task_url
+        payload = {
+            "worker_id": self.worker_id,
+            "lease_duration_seconds": lease_duration_seconds,
+            "batch_size": batch_size
+        }
+
+        try:
+            response = self.session.post(url, data=_encode_json(payload), timeout=self.timeout)
+            response.raise_for_status()
+
+            result = _decode_json(response)
+
+            # No task available
+            if not result.get('success') or result.get('data') is None:
+                return []
+
+            data = result['data']
+            return data if isinstance(data, list) else [data]
+
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Failed to get next tasks: {str(e)}")
+
     def get_presigned_download_url(self, storage_path: str) -> Dict[str, Any]:
         """
         Get presigned URL for downloading input image
 
+        Responses are cached until shortly before they expire.
+
         Args:
             storage_path: Storage path of the input image (e.g., "group-id/photo-id_original.png")
 
         Returns:
             Dict with keys: url, expires_in
         """
+        cache_key = f"download:{storage_path}"
+        cached = self._get_cached_url(cache_key)
+        if cached is not None:
+            return cached
+
         url = f"{self.base_url}/worker/presign"
         payload = {
             "operation": "download",
@@ -78,9 +292,10 @@ class VercelAPIClient:
         }
 
         try:
-            response = self.session.post(url, json=payload, timeout=self.timeout)
+            response = self.session.post(url, data=_encode_json(payload), timeout=self.timeout)
             response.raise_for_status()
-            result = response.json()
+            result = _decode_json(response)
+            self._cache_url(cache_key, result['data'])
             return result['data']
 
         except requests.exceptions.RequestException as e:
@@ -90,6 +305,8 @@ class VercelAPIClient:
         """
         Get presigned URL for uploading result video
 
+        Responses are cached until shortly before they expire.
+
         Args:
             video_item_id: Video item ID (same as item_id)
             file_extension: File extension (default: "mp4")
@@ -97,6 +314,11 @@ class VercelAPIClient:
         Returns:
             Dict with keys: url, expires_in, storage_path
         """
+        cache_key = f"upload:{video_item_id}.{file_extension}"
+        cached = self._get_cached_url(cache_key)
+        if cached is not None:
+            return cached
+
         url = f"{self.base_url}/worker/presign"
         payload = {
             "operation": "upload",
@@ -105,9 +327,10 @@ class VercelAPIClient:
         }
 
         try:
-            response = self.session.post(url, json=payload, timeout=self.timeout)
+            response = self.session.post(url, data=_encode_json(payload), timeout=self.timeout)
             response.raise_for_status()
-            result = response.json()
+            result = _decode_json(response)
+            self._cache_url(cache_key, result['data'])
             return result['data']
 
         except requests.exceptions.RequestException as e:
@@ -147,8 +370,11 @@ class VercelAPIClient:
                 raise ValueError("error_message required for status=failed")
             payload["error_message"] = error_message
 
+        # Lease ends with the report, its heartbeat token is no longer valid
+        self._lease_tokens.pop(item_id, None)
+
         try:
-            response = self.session.post(url, json=payload, timeout=self.timeout)
+            response = self.session.post(url, data=_encode_json(payload), timeout=self.timeout)
             response.raise_for_status()
             return True
 
@@ -159,6 +385,10 @@ class VercelAPIClient:
         """
         Send heartbeat to extend task lease
 
+        Once the server has acknowledged a full heartbeat with a lease_token,
+        later heartbeats for the same item only send that token. A rejected
+        token is dropped and the full payload is sent instead.
+
         Args:
             item_id: Item ID (video_item_id)
             extend_seconds: Seconds to extend lease by (default: 300)
@@ -167,6 +397,18 @@ class VercelAPIClient:
             True if heartbeat successful
         """
         url = f"{self.base_url}/worker/heartbeat"
+
+        token = self._lease_tokens.get(item_id)
+        if token is not None:
+            try:
+                response = self.session.post(url, data=_encode_json({"t": token}), timeout=self.timeout)
+                response.raise_for_status()
+                return True
+
+            except requests.exceptions.RequestException:
+                # Token expired or unknown, retransmit the full heartbeat
+                self._lease_tokens.pop(item_id, None)
+
         payload = {
             "item_id": item_id,
             "worker_id": self.worker_id,
@@ -174,10 +416,69 @@ class VercelAPIClient:
         }
 
         try:
-            response = self.session.post(url, json=payload, timeout=self.timeout)
+            response = self.session.post(url, data=_encode_json(payload), timeout=self.timeout)
             response.raise_for_status()
+
+            try:
+                result = _decode_json(response)
+            except ValueError:
+                result = None
+            data = result.get('data') if isinstance(result, dict) else None
+            if isinstance(data, dict) and data.get('lease_token'):
+                self._lease_tokens[item_id] = data['lease_token']
+
             return True
 
         except requests.exceptions.RequestException as e:
             # Heartbeat is optional, don't raise exception
             return False
+
+    def heartbeat_batch(self, items: List[Tuple[str, int]]) -> Dict[str, bool]:
+        """
+        Send one heartbeat covering several leased items
+
+        Falls back to per-item heartbeat() when the batch request fails; for
+        every later call too if the server rejected or ignored the batch form.
+
+        Args:
+            items: List of (item_id, extend_seconds) tuples
+
+        Returns:
+            Dict mapping item_id to True if its lease was extended
+        """
+        if len(items) > 1 and self._batch_heartbeat_supported:
+            url = f"{self.base_url}/worker/heartbeat"
+            payload = {
+                "worker_id": self.worker_id,
+                "items": [
+                    {"item_id": item_id, "extend_seconds": extend_seconds}
+                    for item_id, extend_seconds in items
+                ]
+            }
+
+            try:
+                response = self.session.post(url, data=_encode_json(payload), timeout=self.timeout)
+                response.raise_for_status()
+                body = _decode_json(response)
+                data = body.get('data') if isinstance(body, dict) else None
+                results = data.get('results') if isinstance(data, dict) else None
+                if isinstance(results, dict):
+                    return {item_id: bool(results.get(item_id, False)) for item_id, _ in items}
+
+                # A 200 without per-item results means the batch form was ignored
+                self._batch_heartbeat_supported = False
+
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                # Transient, keep batching; extend these leases one by one this time
+                pass
+
+            except requests.exceptions.RequestException:
+                # Servers without the batch form may answer with any error
+                # status or body. Stop using it and extend these leases one
+                # by one so none of them lapse.
+                self._batch_heartbeat_supported = False
+
+        return {
+            item_id: self.heartbeat(item_id, extend_seconds=extend_seconds)
+            for item_id, extend_seconds in items
+        }
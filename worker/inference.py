@@ -2,14 +2,35 @@
 Wan2.2 Inference Wrapper
 """
 import subprocess
+import logging
 import os
+import re
+import sys
+import threading
+from collections import deque
 from pathlib import Path
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
+from PIL import Image, ImageOps
+
+
+logger = logging.getLogger("WanWorker")
+
+# Kill generate.py if it runs longer than this
+INFERENCE_TIMEOUT = 3600  # 60 minutes (1 hour)
+
+# Diffusion progress in generate.py output ("step 12/50" or tqdm's "| 12/50 [")
+PROGRESS_PATTERN = re.compile(r'(?:step |\| ?)(\d+)/(\d+)')
+
+# Output that means the run is already lost, abort instead of waiting for exit
+FATAL_OUTPUT_MARKERS = ("CUDA out of memory", "OutOfMemoryError")
 
 
 class WanInference:
     """Wrapper for Wan2.2 generate.py"""
 
+    __slots__ = ('wan_repo_path', 'model_path', 'config', 'progress', 'generate_script',
+                 '_created_dirs', '_cmd_prefix', '_generate', '_pipeline', '_warm_lock')
+
     def __init__(self, wan_repo_path: str, model_path: str, config: Dict[str, Any]):
         """
         Initialize inference wrapper
@@ -22,63 +43,60 @@ class WanInference:
         self.wan_repo_path = Path(wan_repo_path)
         self.model_path = Path(model_path)
         self.config = config
+        self.validate_config()
 
-        # Validate paths
-        if not self.wan_repo_path.exists():
-            raise FileNotFoundError(f"Wan2.2 repo not found: {wan_repo_path}")
-        if not self.model_path.exists():
-            raise FileNotFoundError(f"Model not found: {model_path}")
+        # (step, total) of the running inference, None when unknown
+        self.progress: Optional[Tuple[int, int]] = None
 
         self.generate_script = self.wan_repo_path / "generate.py"
-        if not self.generate_script.exists():
-            raise FileNotFoundError(f"generate.py not found: {self.generate_script}")
 
-    def run(self, input_image_path: str, output_video_path: str,
-            prompt: str = None, video_size: str = None, frame_num: int = None) -> str:
-        """
-        Run Wan2.2 inference
+        # Validate paths (one stat each, model dirs may live on network storage)
+        for path, description in ((self.wan_repo_path, "Wan2.2 repo"),
+                                  (self.model_path, "Model"),
+                                  (self.generate_script, "generate.py")):
+            try:
+                os.stat(path)
+            except FileNotFoundError:
+                raise FileNotFoundError(f"{description} not found: {path}")
 
-        Args:
-            input_image_path: Path to input image
-            output_video_path: Path where output video will be saved
-            prompt: Text prompt (optional, will use default if not provided)
-            video_size: Video size (e.g. "1280*704", optional, uses config default if not provided)
-            frame_num: Number of frames (optional, uses config default 121 if not provided)
+        # Output directories already created by run()
+        self._created_dirs = set()
 
-        Returns:
-            Path to generated video file
+        # Command line options that don't change between tasks
+        self._cmd_prefix = self._build_cmd_prefix()
 
-        Raises:
-            Exception if inference fails
-        """
-        # Validate input
-        if not Path(input_image_path).exists():
-            raise FileNotFoundError(f"Input image not found: {input_image_path}")
+        # Optionally keep the Wan2.2 pipeline resident across jobs instead of
+        # spawning generate.py (and reloading weights) for every task.
+        # Loaded by warmup(), or by the first run() if warmup() wasn't called.
+        self._generate = None
+        self._pipeline = None
+        self._warm_lock = threading.Lock()
 
-        # Ensure output directory exists
-        Path(output_video_path).parent.mkdir(parents=True, exist_ok=True)
+    def warmup(self):
+        """
+        Load the resident pipeline ahead of the first task
 
-        # Convert paths to absolute paths
-        abs_model_path = Path(self.model_path).resolve()
-        abs_input_path = Path(input_image_path).resolve()
-        abs_output_path = Path(output_video_path).resolve()
+        No-op unless persistent_pipeline is set; generate.py subprocesses load
+        their own weights. Safe to call from a background thread and more than
+        once.
+        """
+        if not self.config.get("persistent_pipeline", False):
+            return
 
-        # Determine frame_num (priority: parameter > config > default 121)
-        final_frame_num = frame_num if frame_num is not None else self.config.get("frame_num", 121)
+        with self._warm_lock:
+            if self._pipeline is None:
+                self._load_pipeline()
 
-        # Get task type for model-specific optimization
+    def _build_cmd_prefix(self) -> List[str]:
+        """Build the generate.py arguments shared by every task"""
         task_type = self.config.get("task_type", "ti2v-5B")
 
-        # Build command
         cmd = [
             "python",
             "generate.py",  # Relative path since we use cwd=wan_repo_path
             "--task", task_type,
-            "--ckpt_dir", str(abs_model_path),
-            "--image", str(abs_input_path),
-            "--save_file", str(abs_output_path),
+            "--ckpt_dir", str(self.model_path.resolve()),
             "--size", self.config.get("video_size", "1280*704"),
-            "--frame_num", str(final_frame_num),
             "--sample_steps", str(self.config.get("sample_steps", 50)),
             "--sample_guide_scale", str(self.config.get("cfg_scale", 7.5)),
         ]
@@ -105,25 +123,202 @@ class WanInference:
                 "--convert_model_dtype"
             ])
 
+        return cmd
+
+    def _load_pipeline(self):
+        """Import generate.py as a module and build the Wan2.2 pipeline once"""
+        repo_path = str(self.wan_repo_path.resolve())
+        if repo_path not in sys.path:
+            sys.path.insert(0, repo_path)
+
+        import generate
+        self._generate = generate
+
+        task_type = self.config.get("task_type", "ti2v-5B")
+        if "ti2v" in task_type:
+            pipeline_cls = generate.wan.WanTI2V
+        elif "i2v" in task_type:
+            pipeline_cls = generate.wan.WanI2V
+        else:
+            raise ValueError(f"persistent_pipeline does not support task_type: {task_type}")
+
+        # Same memory options as the subprocess command line
+        self._pipeline = pipeline_cls(
+            config=generate.WAN_CONFIGS[task_type],
+            checkpoint_dir=str(self.model_path.resolve()),
+            device_id=0,
+            rank=0,
+            t5_cpu=(task_type == "ti2v-5B"),
+            convert_model_dtype=True,
+        )
+
+    def _run_pipeline(self, input_path: Path, output_path: Path, prompt: str, frame_num: int):
+        """Run inference on the resident pipeline and save the video"""
+        generate = self._generate
+        task_type = self.config.get("task_type", "ti2v-5B")
+        cfg = generate.WAN_CONFIGS[task_type]
+        size = self.config.get("video_size", "1280*704")
+
+        img = Image.open(input_path)
+        img = ImageOps.exif_transpose(img) if img else img
+        img = img.convert("RGB")
+
+        generate_kwargs = {
+            "max_area": generate.MAX_AREA_CONFIGS[size],
+            "frame_num": frame_num,
+            "shift": cfg.sample_shift,
+            "sample_solver": self.config.get("sample_solver", "unipc"),
+            "sampling_steps": self.config.get("sample_steps", 50),
+            "guide_scale": float(self.config.get("cfg_scale", 7.5)),
+            "offload_model": True,
+        }
+        if "ti2v" in task_type:
+            generate_kwargs["size"] = generate.SIZE_CONFIGS[size]
+
+        video = self._pipeline.generate(
+            prompt or generate.EXAMPLE_PROMPT[task_type]["prompt"],
+            img=img,
+            **generate_kwargs
+        )
+
+        generate.save_video(
+            tensor=video[None],
+            save_file=str(output_path),
+            fps=cfg.sample_fps,
+            nrow=1,
+            normalize=True,
+            value_range=(-1, 1))
+        del video
+
+    def run(self, input_image_path: str, output_video_path: str,
+            prompt: str = None, video_size: str = None, frame_num: int = None) -> str:
+        """
+        Run Wan2.2 inference
+
+        Args:
+            input_image_path: Path to input image
+            output_video_path: Path where output video will be saved
+            prompt: Text prompt (optional, will use default if not provided)
+            video_size: Video size (e.g. "1280*704", optional, uses config default if not provided)
+            frame_num: Number of frames (optional, uses config default 121 if not provided)
+
+        Returns:
+            Path to generated video file
+
+        Raises:
+            Exception if inference fails
+        """
+        # Validate input
+        if not Path(input_image_path).exists():
+            raise FileNotFoundError(f"Input image not found: {input_image_path}")
+
+        # Ensure output directory exists (once per directory)
+        output_dir = Path(output_video_path).parent
+        if output_dir not in self._created_dirs:
+            output_dir.mkdir(parents=True, exist_ok=True)
+            self._created_dirs.add(output_dir)
+
+        # Convert paths to absolute paths
+        abs_input_path = Path(input_image_path).resolve()
+        abs_output_path = Path(output_video_path).resolve()
+
+        # Determine frame_num (priority: parameter > config > default 121)
+        final_frame_num = frame_num if frame_num is not None else self.config.get("frame_num", 121)
+        if (final_frame_num - 1) & 3:
+            raise ValueError(f"frame_num must be 4n+1, got {final_frame_num}")
+
+        # Resident pipeline: no subprocess, weights stay loaded
+        if self.config.get("persistent_pipeline", False):
+            try:
+                if self._pipeline is None:
+                    self.warmup()
+                self._run_pipeline(abs_input_path, abs_output_path, prompt, final_frame_num)
+            except Exception as e:
+                raise Exception(f"Inference execution failed: {str(e)}")
+
+            if not abs_output_path.exists():
+                raise Exception(f"Output file was not created: {abs_output_path}")
+
+            return output_video_path
+
+        # Build command (static options are prepared once in __init__)
+        cmd = self._cmd_prefix + [
+            "--image", str(abs_input_path),
+            "--save_file", str(abs_output_path),
+            "--frame_num", str(final_frame_num),
+        ]
+
         # Add prompt if provided
         if prompt:
             cmd.extend(["--prompt", prompt])
 
-        # Execute inference
+        # Execute inference, streaming output instead of buffering the whole log
+        self.progress = None
+        output_tail = deque(maxlen=50)
+        timed_out = threading.Event()
+        fatal_line = None
+
         try:
             # Change to Wan2.2 directory for execution
-            result = subprocess.run(
+            proc = subprocess.Popen(
                 cmd,
                 cwd=str(self.wan_repo_path),
-                capture_output=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
                 text=True,
-                timeout=3600  # 60 minutes (1 hour) timeout
+                errors='replace',
+                bufsize=1
             )
 
+            def kill_on_timeout():
+                timed_out.set()
+                proc.kill()
+
+            timer = threading.Timer(INFERENCE_TIMEOUT, kill_on_timeout)
+            timer.daemon = True
+            timer.start()
+
+            try:
+                for line in proc.stdout:
+                    line = line.rstrip()
+                    if not line:
+                        continue
+                    output_tail.append(line)
+
+                    match = PROGRESS_PATTERN.search(line)
+                    if match:
+                        progress = (int(match.group(1)), int(match.group(2)))
+                        if progress != self.progress:
+                            self.progress = progress
+                            logger.info(f"[INFERENCE] Step {progress[0]}/{progress[1]}")
+                        continue
+
+                    logger.info(f"[INFERENCE] {line}")
+
+                    if any(marker in line for marker in FATAL_OUTPUT_MARKERS):
+                        fatal_line = line
+                        proc.kill()
+                        break
+
+                returncode = proc.wait()
+            finally:
+                timer.cancel()
+                # Never leave generate.py holding the GPU behind us
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+                proc.stdout.close()
+
+            if timed_out.is_set():
+                raise Exception(f"Inference timed out after {INFERENCE_TIMEOUT // 60} minutes")
+
+            if fatal_line is not None:
+                raise Exception(f"Inference aborted: {fatal_line}")
+
             # Check for errors
-            if result.returncode != 0:
-                error_msg = result.stderr or result.stdout
-                raise Exception(f"Inference failed with code {result.returncode}: {error_msg}")
+            if returncode != 0:
+                error_msg = "\n".join(output_tail)
+                raise Exception(f"Inference failed with code {returncode}: {error_msg}")
 
             # Verify output file was created
             if not abs_output_path.exists():
@@ -131,8 +326,6 @@ class WanInference:
 
             return output_video_path
 
-        except subprocess.TimeoutExpired:
-            raise Exception("Inference timed out after 30 minutes")
         except Exception as e:
             raise Exception(f"Inference execution failed: {str(e)}")
 
@@ -153,7 +346,7 @@ class WanInference:
 
         # Validate frame_num if provided (must be 4n+1)
         frame_num = self.config.get("frame_num", 121)
-        if (frame_num - 1) % 4 != 0:
+        if (frame_num - 1) & 3:
             raise ValueError(f"frame_num must be 4n+1, got {frame_num}")
 
         return True
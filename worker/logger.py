@@ -1,16 +1,26 @@
 """
 Logging utility for Wan Worker
 """
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys
 from pathlib import Path
 from datetime import datetime
 
 
+# Background listener that performs the actual file/console writes
+_listener = None
+
+
 def setup_logger(log_dir="./logs", worker_id="worker"):
     """
     Setup logger with both file and console output
 
+    Records are queued and written by a background listener thread, so
+    logging calls never block on disk or terminal I/O.
+
     Args:
         log_dir: Directory to store log files
         worker_id: Worker identification for log filename
@@ -26,8 +36,13 @@ def setup_logger(log_dir="./logs", worker_id="worker"):
     logger = logging.getLogger("WanWorker")
     logger.setLevel(logging.INFO)
 
+    global _listener
+
     # Clear existing handlers
     logger.handlers = []
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
 
     # File handler
     log_file = log_path / f"{worker_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
@@ -47,12 +62,25 @@ def setup_logger(log_dir="./logs", worker_id="worker"):
     file_handler.setFormatter(formatter)
     console_handler.setFormatter(formatter)
 
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    # Queue records here, write them from the listener thread
+    log_queue = queue.Queue(-1)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
+    _listener.start()
 
     return logger
 
 
+def _stop_listener():
+    """Flush queued records on interpreter exit"""
+    if _listener is not None:
+        _listener.stop()
+
+
+atexit.register(_stop_listener)
+
+
 def log_task_start(logger, task_id, job_id):
     """Log task start"""
     logger.info("="*60)
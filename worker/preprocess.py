@@ -1,9 +1,32 @@
 """
 Image preprocessing for Wan2.2 inference
 """
+import struct
 from PIL import Image, ImageOps
 from pathlib import Path
-from typing import Tuple
+from typing import Optional, Tuple
+
+try:
+    # Installed with Wan2.2's requirements; PIL is used as a fallback
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+
+
+# JPEG start-of-frame markers (carry image dimensions)
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# EXIF orientations that rotate the image by 90 degrees (width/height swap)
+EXIF_ROTATED_ORIENTATIONS = frozenset({5, 6, 7, 8})
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Metadata Pillow also takes an orientation from; rare enough that the header
+# fast path just hands such files to Image.open
+XMP_APP1_PREFIX = b'http://ns.adobe.com/xap/1.0/\x00'
+PNG_TEXT_CHUNKS = frozenset({b'tEXt', b'zTXt', b'iTXt'})
+PNG_ORIENTATION_KEYWORDS = (b'Raw profile type exif\x00', b'XML:com.adobe.xmp\x00')
 
 
 # ti2v-5B supported sizes
@@ -62,16 +85,32 @@ def resize_and_pad(image: Image.Image, target_size: Tuple[int, int],
         new_height = target_height
         new_width = int(target_height * img_ratio)
 
-    # Resize image
-    resized = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    # Compute centered padding
+    left = (target_width - new_width) // 2
+    top = (target_height - new_height) // 2
+
+    if cv2 is not None and image.mode == 'RGB':
+        # Resize and pad in one pass over the pixels, no blank canvas + paste
+        interpolation = cv2.INTER_AREA if new_width < image.width else cv2.INTER_LANCZOS4
+        resized = cv2.resize(np.asarray(image), (new_width, new_height), interpolation=interpolation)
+        padded = cv2.copyMakeBorder(
+            resized,
+            top, target_height - new_height - top,
+            left, target_width - new_width - left,
+            cv2.BORDER_CONSTANT,
+            value=pad_color
+        )
+        return Image.fromarray(padded)
+
+    # Resize image (box-reduce large inputs first so LANCZOS only filters
+    # about 2x the target size instead of the full-resolution photo)
+    resized = image.resize((new_width, new_height), Image.Resampling.LANCZOS, reducing_gap=2.0)
 
     # Create new image with target size and pad color
     padded = Image.new('RGB', target_size, pad_color)
 
     # Paste resized image centered
-    paste_x = (target_width - new_width) // 2
-    paste_y = (target_height - new_height) // 2
-    padded.paste(resized, (paste_x, paste_y))
+    padded.paste(resized, (left, top))
 
     return padded
 
@@ -117,7 +156,17 @@ def preprocess_image(input_path: str, output_path: str = None,
     if output_path is None:
         output_path = input_path
 
-    processed.save(output_path, quality=95)
+    # JPEG at quality 85 is indistinguishable once the video is generated.
+    # WebP defaults to lossy quality 80, so ask for lossless explicitly;
+    # PNG is lossless anyway and ignores quality, which stays at 95 for any
+    # other lossy format.
+    suffix = Path(output_path).suffix.lower()
+    if suffix in ('.jpg', '.jpeg'):
+        processed.save(output_path, quality=85, optimize=True, progressive=True)
+    elif suffix == '.webp':
+        processed.save(output_path, lossless=True)
+    else:
+        processed.save(output_path, quality=95)
 
     # Return path and size string
     size_string = f"{target_size[0]}*{target_size[1]}"
@@ -125,6 +174,150 @@ def preprocess_image(input_path: str, output_path: str = None,
     return output_path, size_string
 
 
+def _read_exif_orientation(tiff: bytes) -> int:
+    """
+    Read the orientation tag from EXIF data
+
+    Args:
+        tiff: EXIF payload (TIFF header and IFDs), optionally prefixed with
+            the "Exif" identifier as in JPEG APP1 segments
+
+    Returns:
+        EXIF orientation (1-8), 1 if absent
+    """
+    if tiff.startswith(b'Exif\x00\x00'):
+        tiff = tiff[6:]
+
+    if tiff[:2] == b'II':
+        endian = '<'
+    elif tiff[:2] == b'MM':
+        endian = '>'
+    else:
+        return 1
+
+    try:
+        ifd_offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+        entry_count = struct.unpack(endian + 'H', tiff[ifd_offset:ifd_offset + 2])[0]
+        for i in range(entry_count):
+            entry = ifd_offset + 2 + i * 12
+            tag = struct.unpack(endian + 'H', tiff[entry:entry + 2])[0]
+            if tag == 0x0112:
+                return struct.unpack(endian + 'H', tiff[entry + 8:entry + 10])[0]
+    except struct.error:
+        pass
+
+    return 1
+
+
+def _read_png_orientation(f) -> Optional[int]:
+    """
+    Find the EXIF orientation of a PNG by walking its chunk headers
+
+    Pixel data is skipped with seeks, so this stays cheap for large images.
+    eXIf may follow IDAT, so the walk runs to IEND.
+
+    Args:
+        f: PNG file object
+
+    Returns:
+        EXIF orientation (1-8), 1 if absent, None if it may come from
+        metadata only Pillow parses
+    """
+    f.seek(len(PNG_SIGNATURE))
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return 1
+        length, chunk_type = struct.unpack('>I4s', header)
+
+        if chunk_type == b'IEND':
+            return 1
+        if chunk_type == b'eXIf':
+            return _read_exif_orientation(f.read(length))
+        if chunk_type in PNG_TEXT_CHUNKS:
+            keyword = f.read(min(length, 32))
+            if keyword.startswith(PNG_ORIENTATION_KEYWORDS):
+                return None
+            f.seek(length - len(keyword) + 4, 1)
+        else:
+            f.seek(length + 4, 1)  # data + CRC
+
+
+def read_image_header_size(image_path: str) -> Optional[Tuple[int, int]]:
+    """
+    Read image dimensions from the PNG/JPEG header without decoding pixels
+
+    EXIF orientation (JPEG APP1, PNG eXIf) is applied, matching
+    ImageOps.exif_transpose. Files that may carry an XMP orientation
+    instead return None so the caller falls back to Image.open.
+
+    Args:
+        image_path: Path to image
+
+    Returns:
+        (width, height) tuple, or None if the format isn't recognized
+    """
+    with open(image_path, 'rb') as f:
+        head = f.read(32)
+
+        # PNG: IHDR chunk holds big-endian width and height
+        if head.startswith(PNG_SIGNATURE) and head[12:16] == b'IHDR':
+            width, height = struct.unpack('>II', head[16:24])
+            orientation = _read_png_orientation(f)
+            if orientation is None:
+                return None
+            if orientation in EXIF_ROTATED_ORIENTATIONS:
+                return height, width
+            return width, height
+
+        if not head.startswith(b'\xff\xd8'):
+            return None
+
+        # JPEG: walk marker segments until the start-of-frame
+        f.seek(2)
+        orientation = 1
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            code = marker[1]
+            while code == 0xFF:
+                fill = f.read(1)
+                if not fill:
+                    return None
+                code = fill[0]
+
+            # Standalone markers have no length field
+            if code == 0x01 or 0xD0 <= code <= 0xD8:
+                continue
+            # Reached entropy-coded data without a frame header
+            if code in (0xD9, 0xDA):
+                return None
+
+            length_bytes = f.read(2)
+            if len(length_bytes) < 2:
+                return None
+            length = struct.unpack('>H', length_bytes)[0]
+
+            if code == 0xE1:
+                segment = f.read(length - 2)
+                if segment.startswith(b'Exif\x00\x00'):
+                    if orientation == 1:
+                        orientation = _read_exif_orientation(segment)
+                elif segment.startswith(XMP_APP1_PREFIX) and b'Orientation' in segment:
+                    return None
+            elif code in JPEG_SOF_MARKERS:
+                frame = f.read(5)
+                if len(frame) < 5:
+                    return None
+                height, width = struct.unpack('>HH', frame[1:5])
+                if orientation in EXIF_ROTATED_ORIENTATIONS:
+                    return height, width
+                return width, height
+            else:
+                f.seek(length - 2, 1)
+
+
 def get_size_for_image(image_path: str) -> str:
     """
     Get appropriate size string for an image without processing it
@@ -135,10 +328,15 @@ def get_size_for_image(image_path: str) -> str:
     Returns:
         Size string like "1280*704" or "704*1280"
     """
-    image = Image.open(image_path)
+    # Fast path: dimensions straight from the PNG/JPEG header
+    size = read_image_header_size(image_path)
 
-    # Apply EXIF orientation if present
-    image = ImageOps.exif_transpose(image) if image else image
+    if size is None:
+        image = Image.open(image_path)
 
-    target_size = get_target_size(image.width, image.height)
+        # Apply EXIF orientation if present
+        image = ImageOps.exif_transpose(image) if image else image
+        size = (image.width, image.height)
+
+    target_size = get_target_size(*size)
     return f"{target_size[0]}*{target_size[1]}"
@@ -1,24 +1,93 @@
 """
 Storage utilities for downloading and uploading files via presigned URLs
 """
+import base64
+import hashlib
+import http.client
+import os
+import shutil
+import threading
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+
+class PresignedURLRejected(Exception):
+    """Storage refused a presigned URL (HTTP 403), typically because it expired"""
+
+
+# MIME types by lowercase file extension
+_CONTENT_TYPES: Dict[str, str] = {
+    '.mp4': 'video/mp4',
+    '.avi': 'video/x-msvideo',
+    '.mov': 'video/quicktime',
+    '.webm': 'video/webm',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp'
+}
+
+# Download copy block bounds; the block is ~1/256 of the file within these
+MIN_DOWNLOAD_CHUNK = 64 * 1024
+MAX_DOWNLOAD_CHUNK = 4 * 1024 * 1024
+
+# Shared adapter so transfers to the storage host reuse TCP/TLS connections.
+# requests.Session is not thread-safe and downloads (main thread) overlap
+# uploads (I/O pool), so each thread gets its own session on top of it.
+_adapter = HTTPAdapter(pool_maxsize=4)
+_local = threading.local()
+
+
+def _get_session() -> requests.Session:
+    """Storage session for the calling thread"""
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        session.mount('https://', _adapter)
+        session.mount('http://', _adapter)
+        _local.session = session
+    return session
+
+
+def _drop_page_cache(file_path: str):
+    """
+    Ask the kernel to evict a transferred file from the page cache
+
+    Keeps model weight pages resident instead of one-off task files.
+    Linux only, no-op elsewhere.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
 
 
-def download_file(presigned_url: str, save_path: str, chunk_size: int = 8192) -> str:
+def download_file(presigned_url: str, save_path: str, chunk_size: Optional[int] = None) -> str:
     """
     Download file from presigned URL
 
     Args:
         presigned_url: Presigned download URL from Vercel API
         save_path: Local path to save the downloaded file
-        chunk_size: Download chunk size in bytes
+        chunk_size: Copy block size in bytes (default: sized from Content-Length)
 
     Returns:
         Path to downloaded file
 
     Raises:
+        PresignedURLRejected if storage rejects the URL (HTTP 403)
         Exception if download fails
     """
     try:
@@ -26,24 +95,94 @@ def download_file(presigned_url: str, save_path: str, chunk_size: int = 8192) ->
         Path(save_path).parent.mkdir(parents=True, exist_ok=True)
 
         # Stream download
-        response = requests.get(presigned_url, stream=True, timeout=300)
-        response.raise_for_status()
+        with _get_session().get(presigned_url, stream=True, timeout=300) as response:
+            response.raise_for_status()
+
+            if chunk_size is None:
+                total = int(response.headers.get('Content-Length') or 0)
+                chunk_size = max(MIN_DOWNLOAD_CHUNK, min(MAX_DOWNLOAD_CHUNK, total // 256 or MIN_DOWNLOAD_CHUNK))
+
+            # Write to file in large blocks copied at C level
+            response.raw.decode_content = True
+            with open(save_path, 'wb') as f:
+                shutil.copyfileobj(response.raw, f, length=chunk_size)
 
-        # Write to file
-        with open(save_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=chunk_size):
-                if chunk:
-                    f.write(chunk)
+        _drop_page_cache(save_path)
 
         return save_path
 
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+        if getattr(getattr(e, 'response', None), 'status_code', None) == 403:
+            raise PresignedURLRejected(f"Failed to download file: {str(e)}")
         raise Exception(f"Failed to download file: {str(e)}")
     except IOError as e:
         raise Exception(f"Failed to save file: {str(e)}")
 
 
-def upload_file(file_path: str, presigned_url: str, content_type: str = "video/mp4") -> bool:
+def _checksum_headers(file_path: str, checksum: str) -> Dict[str, str]:
+    """
+    Build an integrity header for an upload
+
+    Only Content-MD5 is offered: presigned PUTs accept it unsigned, whereas
+    x-amz-* headers (e.g. x-amz-content-sha256) must be signed into the URL
+    by the server or storage rejects the request with 403.
+
+    Args:
+        file_path: Local file path to upload
+        checksum: "md5" (Content-MD5)
+
+    Returns:
+        Header dict
+    """
+    if checksum != 'md5':
+        raise ValueError(f"Unsupported upload checksum: {checksum}")
+
+    with open(file_path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            # Python 3.11+: single pass in C
+            digest = hashlib.file_digest(f, 'md5')
+        else:
+            digest = hashlib.md5()
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+
+    return {'Content-MD5': base64.b64encode(digest.digest()).decode('ascii')}
+
+
+def _sendfile_put(file_path: str, presigned_url: str, headers: Dict[str, str],
+                  file_size: int, timeout: int) -> int:
+    """
+    PUT a file over plain HTTP using sendfile(2)
+
+    The kernel copies the file from page cache straight to the socket,
+    without passing it through Python buffers.
+
+    Returns:
+        HTTP status code
+    """
+    url = urlsplit(presigned_url)
+    target = (url.path or '/') + (f"?{url.query}" if url.query else '')
+
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
+    try:
+        conn.putrequest('PUT', target, skip_accept_encoding=True)
+        for name, value in headers.items():
+            conn.putheader(name, value)
+        conn.putheader('Content-Length', str(file_size))
+        conn.endheaders()
+
+        with open(file_path, 'rb') as f:
+            conn.sock.sendfile(f)
+
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def upload_file(file_path: str, presigned_url: str, content_type: str = "video/mp4",
+                checksum: Optional[str] = None) -> bool:
     """
     Upload file to presigned URL
 
@@ -51,11 +190,13 @@ def upload_file(file_path: str, presigned_url: str, content_type: str = "video/m
         file_path: Local file path to upload
         presigned_url: Presigned upload URL from Vercel API
         content_type: MIME type of the file
+        checksum: Optional integrity header to send, "md5" (Content-MD5)
 
     Returns:
         True if upload successful
 
     Raises:
+        PresignedURLRejected if storage rejects the URL (HTTP 403)
         Exception if upload fails
     """
     try:
@@ -66,19 +207,41 @@ def upload_file(file_path: str, presigned_url: str, content_type: str = "video/m
         # Get file size for logging
         file_size = Path(file_path).stat().st_size
 
+        headers = {'Content-Type': content_type}
+        if checksum:
+            headers.update(_checksum_headers(file_path, checksum))
+
+        # Plain HTTP: zero-copy sendfile. TLS sockets can't sendfile, so HTTPS
+        # URLs (all production presigned URLs) go through the pooled session.
+        if presigned_url.startswith('http://'):
+            try:
+                status = _sendfile_put(file_path, presigned_url, headers, file_size, timeout=600)
+            except (OSError, http.client.HTTPException) as e:
+                raise Exception(f"Failed to upload file: {str(e)}")
+            if status == 403:
+                raise PresignedURLRejected(f"Failed to upload file: HTTP {status}")
+            if status >= 400:
+                raise Exception(f"Failed to upload file: HTTP {status}")
+            _drop_page_cache(file_path)
+            return True
+
         # Upload file
         with open(file_path, 'rb') as f:
-            response = requests.put(
+            response = _get_session().put(
                 presigned_url,
                 data=f,
-                headers={'Content-Type': content_type},
+                headers=headers,
                 timeout=600  # 10 minutes for large files
             )
             response.raise_for_status()
 
+        _drop_page_cache(file_path)
+
         return True
 
     except requests.exceptions.RequestException as e:
+        if getattr(e.response, 'status_code', None) == 403:
+            raise PresignedURLRejected(f"Failed to upload file: {str(e)}")
         raise Exception(f"Failed to upload file: {str(e)}")
     except IOError as e:
         raise Exception(f"Failed to read file: {str(e)}")
@@ -95,12 +258,9 @@ def cleanup_file(file_path: str) -> bool:
         True if deleted, False if file not found
     """
     try:
-        path = Path(file_path)
-        if path.exists():
-            path.unlink()
-            return True
-        return False
-    except Exception:
+        Path(file_path).unlink()
+        return True
+    except OSError:
         return False
 
 
@@ -127,18 +287,4 @@ def get_content_type(filename: str) -> str:
     Returns:
         MIME type string
     """
-    extension = get_file_extension(filename).lower()
-
-    content_types = {
-        '.mp4': 'video/mp4',
-        '.avi': 'video/x-msvideo',
-        '.mov': 'video/quicktime',
-        '.webm': 'video/webm',
-        '.png': 'image/png',
-        '.jpg': 'image/jpeg',
-        '.jpeg': 'image/jpeg',
-        '.gif': 'image/gif',
-        '.webp': 'image/webp'
-    }
-
-    return content_types.get(extension, 'application/octet-stream')
+    return _CONTENT_TYPES.get(get_file_extension(filename).casefold(), 'application/octet-stream')
@@ -2,11 +2,17 @@
 Wan Worker - Main polling loop for task processing
 """
 import os
+import re
 import sys
-import time
+import json
+import hashlib
+import shutil
 import signal
+import stat
 import threading
 import yaml
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, Any
 
@@ -15,10 +21,22 @@ sys.path.insert(0, str(Path(__file__).parent))
 
 from logger import setup_logger, log_task_start, log_task_complete, log_step, log_error
 from api_client import VercelAPIClient
-from storage import download_file, upload_file, cleanup_file, get_content_type
+from storage import download_file, upload_file, cleanup_file, get_content_type, PresignedURLRejected
 from inference import WanInference
 # from preprocess import preprocess_image  # 전처리 미사용 시 주석처리
 
+try:
+    # libyaml-backed parser (bundled with the PyYAML wheels)
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+# RAM-backed default for temp_dir; a 720p output plus its input image needs
+# well under this, the margin covers a few tasks' worth of leftovers.
+SHM_DIR = "/dev/shm"
+SHM_MIN_FREE_BYTES = 2 * 2**30
+DEFAULT_TEMP_DIR = "./temp"
+
 
 class WanWorker:
     """Main worker class for polling and processing tasks"""
@@ -46,6 +64,8 @@ class WanWorker:
             worker_id=self.config["worker_id"],
             timeout=self.config["api_timeout"]
         )
+        if not self.api_client.warm_up():
+            self.logger.warning(f"Vercel API not reachable yet: {self.config['vercel_api_url']}")
 
         # Initialize inference engine
         inference_config = {
@@ -54,7 +74,8 @@ class WanWorker:
             "frame_num": self.config["frame_num"],
             "sample_solver": self.config["sample_solver"],
             "sample_steps": self.config["sample_steps"],
-            "cfg_scale": self.config["cfg_scale"]
+            "cfg_scale": self.config["cfg_scale"],
+            "persistent_pipeline": self.config.get("persistent_pipeline", False)
         }
 
         self.inference = WanInference(
@@ -63,60 +84,279 @@ class WanWorker:
             config=inference_config
         )
 
+        # Load the resident pipeline while the first task is polled and downloaded
+        self._warmup_thread = None
+        if inference_config["persistent_pipeline"]:
+            self._warmup_thread = threading.Thread(
+                target=self._warm_up_inference, name="wan-warmup", daemon=True
+            )
+            self._warmup_thread.start()
+
         # Setup temp directory
+        self.config["temp_dir"] = self._resolve_temp_dir()
         Path(self.config["temp_dir"]).mkdir(parents=True, exist_ok=True)
+        self._temp_dir_str = str(self.config["temp_dir"])
 
         # Shutdown flag
         self.shutdown_requested = False
+        self._shutdown_event = threading.Event()
 
-        # Heartbeat control
-        self.heartbeat_active = False
+        # Heartbeat control (one batched flush covers every in-flight item)
         self.heartbeat_interval = self.config.get("heartbeat_interval", 120)  # 2 minutes
+        self._heartbeat_stop = threading.Event()
+        self._heartbeat_thread = None
+        self._active_items = set()
+        self._active_items_lock = threading.Lock()
+
+        # Background I/O pool (next-task prefetch, concurrent presign requests,
+        # result upload). GPU work only ever runs on the main thread.
+        self._io_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="wan-io")
+        self._next_task_future = None
+
+        # Tasks leased by a batched poll, waiting to be processed
+        self.task_batch_size = self.config.get("task_batch_size", 1)
+        self._task_queue = deque()
 
         self.logger.info("="*60)
         self.logger.info(f"Worker initialized: {self.config['worker_id']}")
         self.logger.info(f"Vercel API: {self.config['vercel_api_url']}")
         self.logger.info(f"Model path: {self.config['model_path']}")
+        self.logger.info(f"Temp dir: {self.config['temp_dir']}")
         self.logger.info("="*60)
 
+    def _resolve_temp_dir(self) -> str:
+        """
+        Pick the directory for per-task input/output files
+
+        An explicit temp_dir is used as-is. When it is unset, the worker uses
+        a RAM-backed directory under /dev/shm if it has enough free space,
+        which keeps the download -> inference -> upload round-trips off disk.
+
+        Returns:
+            Temp directory path
+        """
+        temp_dir = self.config.get("temp_dir")
+        if temp_dir:
+            return temp_dir
+
+        if os.path.isdir(SHM_DIR):
+            try:
+                free = shutil.disk_usage(SHM_DIR).free
+            except OSError:
+                free = 0
+            if free >= SHM_MIN_FREE_BYTES:
+                return os.path.join(SHM_DIR, f"wan-worker-{self.config['worker_id']}")
+            self.logger.warning(
+                f"{SHM_DIR} has only {free / 2**30:.1f} GiB free, using {DEFAULT_TEMP_DIR}"
+            )
+
+        return DEFAULT_TEMP_DIR
+
     def _load_config(self, config_path: str) -> Dict[str, Any]:
-        """Load configuration from YAML file"""
+        """
+        Load configuration from YAML file
+
+        The parsed config is cached as JSON next to the YAML file, keyed by a
+        hash of its content, so restarts skip YAML parsing until it changes.
+        """
         config_file = Path(config_path)
         if not config_file.exists():
             raise FileNotFoundError(f"Config file not found: {config_path}")
 
-        with open(config_file, 'r', encoding='utf-8') as f:
-            config = yaml.safe_load(f)
+        raw = config_file.read_bytes()
+        digest = hashlib.blake2b(raw, digest_size=8).hexdigest()
+        cache_file = config_file.with_suffix(f".{digest}.json")
+
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        config = yaml.load(raw.decode('utf-8'), Loader=YamlLoader)
+        self._write_config_cache(cache_file, config, stat.S_IMODE(config_file.stat().st_mode))
 
         return config
 
+    def _write_config_cache(self, cache_file: Path, config: Dict[str, Any], mode: int):
+        """
+        Atomically write the parsed config cache and drop stale ones
+
+        The cache holds worker_token, so it is created with the YAML file's
+        permissions rather than the umask default.
+        """
+        stale_pattern = re.compile(
+            re.escape(cache_file.name.rsplit('.', 2)[0]) + r"\.[0-9a-f]{16}\.json"
+        )
+        tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+
+        try:
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+            with open(fd, 'w', encoding='utf-8') as f:
+                json.dump(config, f)
+            os.replace(tmp_file, cache_file)
+
+            for path in cache_file.parent.iterdir():
+                if path != cache_file and stale_pattern.fullmatch(path.name):
+                    path.unlink()
+        except (OSError, TypeError, ValueError):
+            # Cache is best effort (read-only dir, non-JSON YAML values)
+            try:
+                tmp_file.unlink()
+            except OSError:
+                pass
+
     def _handle_shutdown(self, signum, frame):
         """Handle shutdown signal"""
         self.logger.info("Shutdown signal received, finishing current task...")
         self.shutdown_requested = True
+        self._shutdown_event.set()
 
-    def _heartbeat_loop(self, item_id: str):
-        """Background heartbeat loop to extend task lease"""
-        while self.heartbeat_active:
-            time.sleep(self.heartbeat_interval)
-            if not self.heartbeat_active:
-                break
+    def _warm_up_inference(self):
+        """Warm up the inference engine (runs on the warm-up thread)"""
+        try:
+            self.inference.warmup()
+            self.logger.info("Inference warm-up complete")
+        except Exception as e:
+            log_error(self.logger, "Inference warm-up failed", e)
+
+    def _heartbeat_loop(self):
+        """Flush heartbeats every heartbeat_interval until stopped"""
+        while not self._heartbeat_stop.wait(self.heartbeat_interval):
+            self._flush_heartbeats()
+
+    def _flush_heartbeats(self):
+        """Extend the lease of every in-flight item with a single request"""
+        with self._active_items_lock:
+            item_ids = list(self._active_items)
+
+        if item_ids:
             try:
-                success = self.api_client.heartbeat(item_id, extend_seconds=300)
-                if success:
-                    self.logger.info(f"[HEARTBEAT] Lease extended for item {item_id}")
+                results = self.api_client.heartbeat_batch(
+                    [(item_id, 300) for item_id in item_ids]
+                )
+                for item_id, success in results.items():
+                    if success:
+                        self.logger.info(f"[HEARTBEAT] Lease extended for item {item_id}")
+                    else:
+                        self.logger.warning(f"[HEARTBEAT] Failed for item {item_id}")
             except Exception as e:
                 self.logger.warning(f"[HEARTBEAT] Failed: {e}")
 
+    def _request_tasks(self):
+        """Poll the API for up to task_batch_size tasks"""
+        lease_duration_seconds = self.config.get("lease_duration_seconds", 600)
+
+        if self.task_batch_size > 1:
+            return self.api_client.get_next_tasks(
+                batch_size=self.task_batch_size,
+                lease_duration_seconds=lease_duration_seconds
+            )
+
+        task = self.api_client.get_next_task(lease_duration_seconds=lease_duration_seconds)
+        return [task] if task is not None else []
+
+    def _prefetch_next_task(self):
+        """Start polling for the next task in the background"""
+        if self.shutdown_requested or self._next_task_future is not None or self._task_queue:
+            return
+        self._next_task_future = self._io_pool.submit(self._request_tasks)
+
+    def _get_next_task(self):
+        """
+        Return the next task to process, or None if none is available
+
+        Tasks come from the local queue first, then from a pending prefetch,
+        then from a fresh poll.
+        """
+        if not self._task_queue:
+            future, self._next_task_future = self._next_task_future, None
+            tasks = future.result() if future is not None else self._request_tasks()
+
+            # Queued tasks are leased, keep them alive until processed
+            with self._active_items_lock:
+                self._active_items.update(task["item_id"] for task in tasks)
+            self._task_queue.extend(tasks)
+
+        return self._task_queue.popleft() if self._task_queue else None
+
+    def _fail_task(self, item_id: str, error: Exception, temp_input: str, temp_output: str):
+        """Report a failed task and remove its temp files"""
+        log_error(self.logger, f"Task {item_id} failed", error)
+
+        try:
+            self.api_client.report_task_result(
+                item_id=item_id,
+                status="failed",
+                error_message=str(error)
+            )
+        except Exception as report_error:
+            log_error(self.logger, "Failed to report task failure", report_error)
+
+        log_task_complete(self.logger, item_id, "FAILED")
+
+        # Cleanup temp files
+        cleanup_file(temp_input)
+        cleanup_file(temp_output)
+
+    def _upload_and_report(self, item_id: str, temp_input: str, temp_output: str,
+                           upload_url: str, video_storage_path: str):
+        """Upload the result video and report completion (runs on the I/O pool)"""
+        try:
+            # Step 5: Upload result
+            log_step(self.logger, 5, f"Uploading result video for item {item_id}...")
+            try:
+                upload_file(temp_output, upload_url, "video/mp4",
+                            checksum=self.config.get("upload_checksum"))
+            except PresignedURLRejected as e:
+                # Cached URL no longer accepted, presign again and retry once
+                self.logger.warning(f"Upload URL rejected, requesting a new one: {e}")
+                self.api_client.invalidate_presigned_upload_url(item_id, "mp4")
+                presign_data = self.api_client.get_presigned_upload_url(
+                    video_item_id=item_id,
+                    file_extension="mp4"
+                )
+                video_storage_path = presign_data["storage_path"]
+                upload_file(temp_output, presign_data["url"], "video/mp4",
+                            checksum=self.config.get("upload_checksum"))
+            self.logger.info(f"Uploaded to: {video_storage_path}")
+
+            # Step 6: Report success
+            log_step(self.logger, 6, f"Reporting completion of item {item_id}...")
+            self.api_client.report_task_result(
+                item_id=item_id,
+                status="completed",
+                video_storage_path=video_storage_path
+            )
+
+            log_task_complete(self.logger, item_id, "SUCCESS")
+
+            # Cleanup temp files
+            if self.config.get("auto_cleanup_temp", True):
+                cleanup_file(temp_input)
+                cleanup_file(temp_output)
+
+        except Exception as e:
+            self._fail_task(item_id, e, temp_input, temp_output)
+
+        finally:
+            # Stop heartbeats for this item
+            with self._active_items_lock:
+                self._active_items.discard(item_id)
+
     def process_task(self, task: Dict[str, Any]) -> bool:
         """
         Process a single task
 
+        Inference runs here; the upload and completion report are handed to the
+        I/O pool so the next task can start while the video uploads.
+
         Args:
             task: Task dictionary from API
 
         Returns:
-            True if task completed successfully, False otherwise
+            True if inference succeeded and the result was queued for upload,
+            False otherwise
         """
         item_id = task["item_id"]
         group_id = task.get("group_id", "unknown")
@@ -127,46 +367,72 @@ class WanWorker:
         log_task_start(self.logger, item_id, group_id)
 
         # Define temp file paths
-        input_filename = Path(photo_storage_path).name
-        temp_input = Path(self.config["temp_dir"]) / f"{item_id}_input{Path(input_filename).suffix}"
-        temp_output = Path(self.config["temp_dir"]) / f"{item_id}_output.mp4"
+        input_filename = os.path.basename(photo_storage_path)
+        input_ext = os.path.splitext(input_filename)[1]
+        temp_input = os.path.join(self._temp_dir_str, f"{item_id}_input{input_ext}")
+        temp_output = os.path.join(self._temp_dir_str, f"{item_id}_output.mp4")
 
-        # Start heartbeat thread
-        self.heartbeat_active = True
-        heartbeat_thread = threading.Thread(target=self._heartbeat_loop, args=(item_id,))
-        heartbeat_thread.daemon = True
-        heartbeat_thread.start()
+        # Keep the lease alive while we work on it
+        with self._active_items_lock:
+            self._active_items.add(item_id)
+        handed_off = False
+        upload_presign_future = None
 
         try:
-            # Step 1: Get presigned download URL
+            # Step 1: Get presigned download URL. The upload URL only depends on
+            # item_id, so request it in the background now; the client caches it
+            # and it is collected after inference.
             log_step(self.logger, 1, "Getting download URL...")
+            upload_presign_future = self._io_pool.submit(
+                self.api_client.get_presigned_upload_url,
+                video_item_id=item_id,
+                file_extension="mp4"
+            )
             presign_data = self.api_client.get_presigned_download_url(photo_storage_path)
             download_url = presign_data["url"]
 
             # Step 2: Download input image
             log_step(self.logger, 2, f"Downloading input image: {input_filename}")
-            download_file(download_url, str(temp_input))
+            try:
+                download_file(download_url, temp_input)
+            except PresignedURLRejected as e:
+                # Cached URL no longer accepted, presign again and retry once
+                self.logger.warning(f"Download URL rejected, requesting a new one: {e}")
+                self.api_client.invalidate_presigned_download_url(photo_storage_path)
+                download_url = self.api_client.get_presigned_download_url(photo_storage_path)["url"]
+                download_file(download_url, temp_input)
             self.logger.info(f"Downloaded to: {temp_input}")
 
             # # Step 2.5: Preprocess image (resize + pad to supported size)
             # log_step(self.logger, "2.5", "Preprocessing image...")
-            # processed_path, video_size = preprocess_image(str(temp_input))
+            # processed_path, video_size = preprocess_image(temp_input)
             # self.logger.info(f"Preprocessed to size: {video_size}")
 
             # Step 3: Run inference
+            if self._warmup_thread is not None:
+                self._warmup_thread.join()
+                self._warmup_thread = None
             log_step(self.logger, 3, "Running Wan2.2 inference...")
             self.logger.info(f"Prompt: {prompt if prompt else '(default)'}")
             self.logger.info(f"Frame num: {frame_num if frame_num else '(default: 121)'}")
             self.inference.run(
-                input_image_path=str(temp_input),
-                output_video_path=str(temp_output),
+                input_image_path=temp_input,
+                output_video_path=temp_output,
                 prompt=prompt,
                 frame_num=frame_num  # Pass frame_num from API (None = use default 121)
             )
             self.logger.info(f"Inference complete: {temp_output}")
 
-            # Step 4: Get presigned upload URL
+            # GPU is free, overlap the next poll with upload and report
+            self._prefetch_next_task()
+
+            # Step 4: Get presigned upload URL (cached since step 1 unless near
+            # expiry; an early request that failed is simply retried here)
             log_step(self.logger, 4, "Getting upload URL...")
+            try:
+                upload_presign_future.result()
+            except Exception as e:
+                self.logger.warning(f"Early upload URL request failed, retrying: {e}")
             presign_data = self.api_client.get_presigned_upload_url(
                 video_item_id=item_id,
                 file_extension="mp4"
@@ -174,53 +440,28 @@ class WanWorker:
             upload_url = presign_data["url"]
             video_storage_path = presign_data["storage_path"]
 
-            # Step 5: Upload result
-            log_step(self.logger, 5, "Uploading result video...")
-            upload_file(str(temp_output), upload_url, "video/mp4")
-            self.logger.info(f"Uploaded to: {video_storage_path}")
-
-            # Step 6: Report success
-            log_step(self.logger, 6, "Reporting task completion...")
-            self.api_client.report_task_result(
-                item_id=item_id,
-                status="completed",
-                video_storage_path=video_storage_path
+            # Steps 5-6: Upload and report in the background
+            self._io_pool.submit(
+                self._upload_and_report,
+                item_id, temp_input, temp_output, upload_url, video_storage_path
             )
-
-            log_task_complete(self.logger, item_id, "SUCCESS")
-
-            # Cleanup temp files
-            if self.config.get("auto_cleanup_temp", True):
-                cleanup_file(str(temp_input))
-                cleanup_file(str(temp_output))
+            handed_off = True
 
             return True
 
         except Exception as e:
-            # Report failure
-            log_error(self.logger, f"Task {item_id} failed", e)
-
-            try:
-                self.api_client.report_task_result(
-                    item_id=item_id,
-                    status="failed",
-                    error_message=str(e)
-                )
-            except Exception as report_error:
-                log_error(self.logger, "Failed to report task failure", report_error)
-
-            log_task_complete(self.logger, item_id, "FAILED")
-
-            # Cleanup temp files
-            cleanup_file(str(temp_input))
-            cleanup_file(str(temp_output))
+            # Upload URL is no longer needed
+            if upload_presign_future is not None:
+                upload_presign_future.cancel()
 
+            self._fail_task(item_id, e, temp_input, temp_output)
             return False
 
         finally:
-            # Stop heartbeat thread
-            self.heartbeat_active = False
-            heartbeat_thread.join(timeout=1)
+            # Stop heartbeats for this item unless the upload still holds the lease
+            if not handed_off:
+                with self._active_items_lock:
+                    self._active_items.discard(item_id)
 
     def run(self):
         """Main polling loop"""
@@ -228,6 +469,12 @@ class WanWorker:
         signal.signal(signal.SIGINT, self._handle_shutdown)
         signal.signal(signal.SIGTERM, self._handle_shutdown)
 
+        # Start the heartbeat thread (lives for the whole polling loop)
+        self._heartbeat_thread = threading.Thread(
+            target=self._heartbeat_loop, name="wan-heartbeat", daemon=True
+        )
+        self._heartbeat_thread.start()
+
         self.logger.info("Starting polling loop...")
         self.logger.info(f"Polling interval: {self.config['polling_interval']} seconds")
         self.logger.info("")
@@ -236,15 +483,13 @@ class WanWorker:
             try:
                 # Get next task
                 self.logger.info("[POLLING] Requesting next task...")
-                task = self.api_client.get_next_task(
-                    lease_duration_seconds=self.config.get("lease_duration_seconds", 600)
-                )
+                task = self._get_next_task()
 
                 if task is None:
                     self.logger.info("[IDLE] No task available")
                     self.logger.info(f"Waiting {self.config['polling_interval']} seconds...")
                     self.logger.info("")
-                    time.sleep(self.config["polling_interval"])
+                    self._shutdown_event.wait(self.config["polling_interval"])
                     continue
 
                 # Process task
@@ -252,8 +497,9 @@ class WanWorker:
                 self.logger.info("")
                 success = self.process_task(task)
 
-                # Brief pause before next poll
-                time.sleep(1)
+                # Brief pause before next poll (a prefetched poll is already in flight)
+                if self._next_task_future is None:
+                    self._shutdown_event.wait(1)
 
             except KeyboardInterrupt:
                 self.logger.info("KeyboardInterrupt received, shutting down...")
@@ -262,7 +508,24 @@ class WanWorker:
             except Exception as e:
                 log_error(self.logger, "Error in main loop", e)
                 self.logger.info(f"Retrying in {self.config['polling_interval']} seconds...")
-                time.sleep(self.config["polling_interval"])
+                self._shutdown_event.wait(self.config["polling_interval"])
+
+        # Tasks leased but not processed before shutdown are left to lease expiry
+        if self._next_task_future is not None:
+            self.logger.warning("Prefetched task not processed, its lease will expire")
+        if self._task_queue:
+            self.logger.warning(f"{len(self._task_queue)} queued task(s) not processed, their leases will expire")
+            with self._active_items_lock:
+                self._active_items.difference_update(task["item_id"] for task in self._task_queue)
+            self._task_queue.clear()
+
+        # Let in-flight uploads finish and report (heartbeats still running)
+        self.logger.info("Waiting for pending uploads...")
+        self._io_pool.shutdown(wait=True)
+
+        # Stop heartbeats
+        self._heartbeat_stop.set()
+        self._heartbeat_thread.join(timeout=self.config["api_timeout"])
 
         self.logger.info("Worker shutdown complete")
 